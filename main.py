@@ -1,14 +1,39 @@
 import asyncio
+import csv
+import gzip
+import contextlib
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
 import sqlite3
-from datetime import datetime
-from typing import List, Optional, Dict, Tuple
-
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+import struct
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import List, Optional, Dict, Tuple, Iterator, Set
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramEntityTooLarge, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.filters import Command, CommandObject
+from aiogram.methods import GetUpdates
 from aiogram.types import (
-    InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery,
+    InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery, FSInputFile, InputFile,
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -18,11 +43,644 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "8248662151:AAFF5KJbigOsAUB4ZSQSJwjOWELvl_l5i
 ADMIN_IDS_STR = os.getenv("ADMIN_IDS", "6555503209")
 ADMIN_IDS: List[int] = [int(x.strip()) for x in ADMIN_IDS_STR.split(",") if x.strip()]
 
+API_CALL_TIMEOUT = float(os.getenv("API_CALL_TIMEOUT", "10"))
+API_CALL_DEADLINE = float(os.getenv("API_CALL_DEADLINE", "30"))
+API_UPLOAD_TIMEOUT = float(os.getenv("API_UPLOAD_TIMEOUT", "300"))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
+API_BACKOFF_BASE = float(os.getenv("API_BACKOFF_BASE", "0.5"))
+API_BACKOFF_MAX = float(os.getenv("API_BACKOFF_MAX", "8"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+MAX_IN_FLIGHT_UPDATES = int(os.getenv("MAX_IN_FLIGHT_UPDATES", "16"))
+MAX_UPDATE_BACKLOG = int(os.getenv("MAX_UPDATE_BACKLOG", "200"))
+ADMISSION_WAIT_TIMEOUT = float(os.getenv("ADMISSION_WAIT_TIMEOUT", "8"))
+MAX_UPDATES_PER_USER_QUEUE = int(os.getenv("MAX_UPDATES_PER_USER_QUEUE", "10"))
+BUSY_NOTICE_INTERVAL = float(os.getenv("BUSY_NOTICE_INTERVAL", "10"))
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "traces.jsonl")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+TRACE_LOG_MAX_BYTES = int(os.getenv("TRACE_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_LOG_BACKUPS = int(os.getenv("TRACE_LOG_BACKUPS", "3"))
+TRACE_MAX_SPANS = 500
+
+# ---- tracing ----
+class Trace:
+    """
+    Spans of one update. Spans are kept in memory and written as a single
+    JSON line when the update is done, if the trace is sampled or slow.
+    """
+    def __init__(self, name: str, attrs: Dict):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.started_at = datetime.utcnow().isoformat(sep=' ', timespec='milliseconds')
+        self.t0 = time.perf_counter()
+        self.spans: List[Dict] = []
+        self._ids = itertools.count(1)
+        self.finished = False
+
+    def add_span(self, span_id: int, parent: Optional[int], name: str, start: float, end: float, attrs: Dict):
+        if self.finished or len(self.spans) >= TRACE_MAX_SPANS:
+            return
+        self.spans.append({
+            "id": span_id,
+            "parent": parent,
+            "name": name,
+            "start_ms": round((start - self.t0) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3),
+            **({"attrs": attrs} if attrs else {}),
+        })
+
+_CURRENT_TRACE: ContextVar[Optional[Trace]] = ContextVar("_CURRENT_TRACE", default=None)
+_CURRENT_SPAN: ContextVar[Optional[int]] = ContextVar("_CURRENT_SPAN", default=None)
+
+@contextlib.contextmanager
+def _span(name: str, **attrs):
+    """
+    Records a span in the current update's trace; a no-op outside of one.
+    """
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        yield
+        return
+    span_id = next(trace._ids)
+    parent = _CURRENT_SPAN.get()
+    token = _CURRENT_SPAN.set(span_id)
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        _CURRENT_SPAN.reset(token)
+        trace.add_span(span_id, parent, name, start, time.perf_counter(), attrs)
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+_TRACE_QUEUE: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=10000)
+trace_logger = logging.getLogger("traces")
+trace_logger.propagate = False
+trace_logger.setLevel(logging.INFO)
+trace_logger.addHandler(_DroppingQueueHandler(_TRACE_QUEUE))
+_trace_listener: Optional[logging.handlers.QueueListener] = None
+
+def _start_trace_writer():
+    """
+    Trace lines are formatted on the event loop but written to the rotating
+    file by a QueueListener thread.
+    """
+    global _trace_listener
+    if not TRACE_LOG_PATH or _trace_listener is not None:
+        return
+    file_handler = logging.handlers.RotatingFileHandler(
+        TRACE_LOG_PATH, maxBytes=TRACE_LOG_MAX_BYTES, backupCount=TRACE_LOG_BACKUPS, encoding="utf-8"
+    )
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    _trace_listener = logging.handlers.QueueListener(_TRACE_QUEUE, file_handler)
+    _trace_listener.start()
+
+def _stop_trace_writer():
+    global _trace_listener
+    if _trace_listener is not None:
+        _trace_listener.stop()
+        _trace_listener = None
+
+def _finish_trace(trace: Trace):
+    trace.finished = True
+    duration_ms = (time.perf_counter() - trace.t0) * 1000
+    if _trace_listener is None:
+        return
+    if duration_ms < TRACE_SLOW_MS and random.random() >= TRACE_SAMPLE_RATE:
+        return
+    trace_logger.info(json.dumps({
+        "trace_id": trace.trace_id,
+        "name": trace.name,
+        "started_at": trace.started_at,
+        "duration_ms": round(duration_ms, 3),
+        "attrs": trace.attrs,
+        "spans": trace.spans,
+    }, ensure_ascii=False))
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Outermost update middleware: opens a trace for the update and a root span
+    around everything below it (admission, filters, handler).
+    """
+    async def __call__(self, handler, event: types.Update, data):
+        attrs: Dict = {"update_id": event.update_id}
+        if event.callback_query:
+            name = "callback_query"
+            attrs["data"] = event.callback_query.data
+            attrs["user_id"] = event.callback_query.from_user.id
+        elif event.message:
+            name = "message"
+            attrs["user_id"] = event.message.from_user.id if event.message.from_user else None
+            if event.message.text and event.message.text.startswith("/"):
+                attrs["command"] = event.message.text.split()[0]
+        else:
+            name = event.event_type
+        trace = Trace(name, attrs)
+        token = _CURRENT_TRACE.set(trace)
+        try:
+            with _span(f"update.{name}"):
+                return await handler(event, data)
+        finally:
+            _CURRENT_TRACE.reset(token)
+            _finish_trace(trace)
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        with _span(f"api.{type(method).__name__}"):
+            return await make_request(bot, method)
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        if _CURRENT_TRACE.get() is None:
+            return super().execute(sql, parameters)
+        with _span("sql", statement=" ".join(sql.split())[:120]):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if _CURRENT_TRACE.get() is None:
+            return super().executemany(sql, seq_of_parameters)
+        with _span("sql", statement=" ".join(sql.split())[:120], many=True):
+            return super().executemany(sql, seq_of_parameters)
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# ---- trace report ----
+def _critical_path(spans: List[Dict]) -> List[Tuple[int, Dict]]:
+    """
+    Returns (depth, span) pairs in time order. Starting from the root, walk
+    back from the end of each span, keeping the child that finished last,
+    then the child that finished last before that one started, and so on.
+    """
+    def end(sp: Dict) -> float:
+        return sp["start_ms"] + sp["duration_ms"]
+
+    children: Dict[Optional[int], List[Dict]] = {}
+    for sp in spans:
+        children.setdefault(sp["parent"], []).append(sp)
+
+    def expand(sp: Dict, depth: int) -> List[Tuple[int, Dict]]:
+        chain = []
+        boundary = float("inf")
+        for child in sorted(children.get(sp["id"], []), key=end, reverse=True):
+            if end(child) <= boundary:
+                chain.append(child)
+                boundary = child["start_ms"]
+        out = [(depth, sp)]
+        for child in reversed(chain):
+            out.extend(expand(child, depth + 1))
+        return out
+
+    roots = children.get(None, [])
+    return expand(max(roots, key=end), 0) if roots else []
+
+def print_trace_report(path: str = TRACE_LOG_PATH, top: int = 10):
+    """
+    python main.py traces [path] [top]: slowest traces with their critical path
+    """
+    files = [path] + [f"{path}.{i}" for i in range(1, TRACE_LOG_BACKUPS + 1)]
+    traces = []
+    for fname in files:
+        if not os.path.exists(fname):
+            continue
+        with open(fname, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    traces.append(json.loads(line))
+                except ValueError:
+                    continue
+    traces.sort(key=lambda t: t["duration_ms"], reverse=True)
+    print(f"{len(traces)} traces in {path}*")
+    for t in traces[:top]:
+        attrs = " ".join(f"{k}={v}" for k, v in t.get("attrs", {}).items())
+        print(f"\n{t['trace_id']}  {t['duration_ms']:.1f} ms  {t['name']}  {t['started_at']}  {attrs}")
+        by_name: Dict[str, List[float]] = {}
+        for sp in t["spans"]:
+            key = sp["name"].split(".")[0]
+            by_name.setdefault(key, []).append(sp["duration_ms"])
+        print("  totals: " + ", ".join(f"{k} x{len(v)} {sum(v):.1f} ms" for k, v in sorted(by_name.items())))
+        for depth, sp in _critical_path(t["spans"]):
+            stmt = sp.get("attrs", {}).get("statement", "")
+            print(f"  {'  ' * depth}{sp['name']}  +{sp['start_ms']:.1f} ms  {sp['duration_ms']:.1f} ms  {stmt}")
+
+
+# ---- Bot API resilience ----
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive transient failures. While open,
+    non-critical calls are rejected right away; after `reset_seconds` one
+    probe call is let through (half-open) and its result closes or re-opens it.
+    """
+    def __init__(self, threshold: int, reset_seconds: float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self, critical: bool) -> bool:
+        if self.opened_at is None or critical:
+            return True
+        if not self._probing and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self._probing = True
+            return True
+        return False
+
+    def release_probe(self):
+        # the probe ended without telling us anything about the API
+        self._probing = False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Bot API circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning("Bot API circuit opened after %s failures", self.failures)
+            self.opened_at = time.monotonic()
+
+API_BREAKER = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+
+# Background work may set API_CRITICAL to False to be shed first while the
+# circuit is open. Only do that for work that is retried later (see
+# admin_sync_worker): a shed call is simply lost otherwise.
+API_CRITICAL: ContextVar[bool] = ContextVar("API_CRITICAL", default=True)
+# methods that create a message: repeating one after an ambiguous failure may post it twice
+_NON_IDEMPOTENT_PREFIXES = ("Send", "Copy", "Forward")
+
+def _backoff_delay(attempt: int) -> float:
+    return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * (2 ** attempt)))
+
+def _is_upload(method) -> bool:
+    for value in method.__dict__.values():
+        if isinstance(value, InputFile):
+            return True
+        if isinstance(value, list) and any(isinstance(getattr(item, "media", None), InputFile) for item in value):
+            return True
+    return False
+
+def _never_delivered(error: Exception) -> bool:
+    """True if the error proves Telegram did not execute the request."""
+    if isinstance(error, TelegramRetryAfter):
+        return True
+    # aiogram prefixes the aiohttp error name; a failed connect means nothing was sent
+    return isinstance(error, TelegramNetworkError) and error.message.startswith("ClientConnectorError")
+
+class ResilienceMiddleware(BaseRequestMiddleware):
+    """
+    Wraps every Bot API call: per-attempt timeout, overall deadline,
+    jittered exponential backoff for transient errors only, and the
+    circuit breaker. Long polling (GetUpdates) is left to the dispatcher.
+    Message-creating calls are repeated only when the request provably
+    never reached Telegram; uploads get API_UPLOAD_TIMEOUT instead of the
+    per-call timeout. While the circuit is open nothing is retried.
+    """
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+
+        critical = API_CRITICAL.get()
+        if not API_BREAKER.allow(critical):
+            raise CircuitOpenError(f"Bot API circuit is open, {type(method).__name__} shed")
+
+        idempotent = not type(method).__name__.startswith(_NON_IDEMPOTENT_PREFIXES)
+        if _is_upload(method):
+            call_timeout = API_UPLOAD_TIMEOUT
+            deadline_seconds = max(API_CALL_DEADLINE, API_UPLOAD_TIMEOUT)
+        else:
+            call_timeout = API_CALL_TIMEOUT
+            deadline_seconds = API_CALL_DEADLINE
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + deadline_seconds
+        attempt = 0
+        while True:
+            remaining = deadline - loop.time()
+            try:
+                result = await asyncio.wait_for(make_request(bot, method), min(call_timeout, remaining))
+            except TelegramRetryAfter as e:
+                # flood control is not an outage, so the breaker is left alone
+                API_BREAKER.release_probe()
+                delay = e.retry_after
+                error: Exception = e
+            except TelegramEntityTooLarge:
+                API_BREAKER.record_success()
+                raise
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                API_BREAKER.record_failure()
+                delay = _backoff_delay(attempt)
+                error = e
+            except TelegramAPIError:
+                # any other API error is an answer from Telegram, so the API is up
+                API_BREAKER.record_success()
+                raise
+            except BaseException:
+                API_BREAKER.release_probe()
+                raise
+            else:
+                API_BREAKER.record_success()
+                return result
+
+            attempt += 1
+            if attempt > API_MAX_RETRIES or loop.time() + delay >= deadline:
+                raise error
+            if API_BREAKER.is_open or not (idempotent or _never_delivered(error)):
+                raise error
+            logger.warning("%s failed (%s), retry %s in %.1fs", type(method).__name__, type(error).__name__, attempt, delay)
+            await asyncio.sleep(delay)
+
+# ---- admission control ----
+PRIORITY_CALLBACK = 0
+PRIORITY_MESSAGE = 1
+PRIORITY_BACKGROUND = 2
+
+class AdmissionController:
+    """
+    Global in-flight limit with a bounded, priority-ordered backlog.
+    A released slot is handed directly to the highest-priority waiter
+    (lowest number, FIFO within a priority).
+    """
+    def __init__(self, limit: int, backlog: int):
+        self.limit = limit
+        self.backlog = backlog
+        self.in_flight = 0
+        self.waiting = 0
+        self.shed = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: int, timeout: Optional[float] = None, bounded: bool = True) -> bool:
+        """
+        Returns False if the backlog is full (when `bounded`) or no slot
+        became free within `timeout`.
+        """
+        if self.in_flight < self.limit and not self.waiting:
+            self.in_flight += 1
+            return True
+        if bounded and self.waiting >= self.backlog:
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(fut, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(True)
+                return
+        self.in_flight -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_BACKGROUND):
+        """
+        For background work: waits for a slot (never shed), so it only
+        runs when interactive updates leave room.
+        """
+        await self.acquire(priority, bounded=False)
+        try:
+            yield
+        finally:
+            self.release()
+
+ADMISSION = AdmissionController(MAX_IN_FLIGHT_UPDATES, MAX_UPDATE_BACKLOG)
+
+# chat_id -> monotonic time of the last "bot is busy" reply
+_BUSY_NOTICE_TIMES: Dict[int, float] = {}
+
+async def _reply_busy(message: Message, text: str):
+    """
+    Tells the user their message was dropped, at most once per
+    BUSY_NOTICE_INTERVAL per chat so a flood does not get a reply each.
+    """
+    now = time.monotonic()
+    if now - _BUSY_NOTICE_TIMES.get(message.chat.id, float("-inf")) < BUSY_NOTICE_INTERVAL:
+        return
+    _BUSY_NOTICE_TIMES[message.chat.id] = now
+    if len(_BUSY_NOTICE_TIMES) > 10000:
+        cutoff = now - BUSY_NOTICE_INTERVAL
+        for chat_id in [c for c, t in _BUSY_NOTICE_TIMES.items() if t < cutoff]:
+            del _BUSY_NOTICE_TIMES[chat_id]
+    try:
+        await message.answer(text)
+    except Exception:
+        pass
+
+class AdmissionMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: types.Update, data):
+        priority = PRIORITY_CALLBACK if event.callback_query else PRIORITY_MESSAGE
+        with _span("admission.wait"):
+            admitted = await ADMISSION.acquire(priority, ADMISSION_WAIT_TIMEOUT)
+        if not admitted:
+            ADMISSION.shed += 1
+            logger.warning("Overloaded, shedding update %s (in flight %s, waiting %s)", event.update_id, ADMISSION.in_flight, ADMISSION.waiting)
+            if event.callback_query:
+                try:
+                    await event.callback_query.answer("Бот перегружен, попробуйте ещё раз через пару секунд.")
+                except Exception:
+                    pass
+            elif event.message:
+                await _reply_busy(event.message, "Бот перегружен, попробуйте ещё раз через пару секунд.")
+            return None
+        try:
+            with _span("handler"):
+                return await handler(event, data)
+        finally:
+            ADMISSION.release()
+
+# ---- per-user ordering ----
+class KeyedLocks:
+    """
+    One asyncio.Lock per key, created on first use and dropped as soon as
+    nobody holds or waits for it, so idle users cost no memory.
+    """
+    def __init__(self):
+        self._entries: Dict[int, List] = {}  # key -> [lock, holders + waiters]
+
+    def pending(self, key: int) -> int:
+        entry = self._entries.get(key)
+        return entry[1] if entry else 0
+
+    async def acquire(self, key: int):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._unref(key, entry)
+            raise
+
+    def release(self, key: int):
+        entry = self._entries[key]
+        entry[0].release()
+        self._unref(key, entry)
+
+    def _unref(self, key: int, entry: List):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._entries[key]
+
+USER_LOCKS = KeyedLocks()
+# (user_id, callback data) of callbacks queued or running
+_INFLIGHT_CALLBACKS: Set[Tuple[int, str]] = set()
+
+class UserSerializationMiddleware(BaseMiddleware):
+    """
+    Runs updates of one user strictly one after another, so FSM handlers
+    never see REVIEW_SESSIONS[uid] change under them; different users still
+    run in parallel. A callback identical to one already queued or running
+    for the same user (double tap) is answered and dropped.
+    Admins outside of a review or edit dialog are not serialized: moderation
+    is guarded by versions and claims, and a long /export or /backup must
+    not hold up their approve/reject taps.
+    """
+    async def __call__(self, handler, event: types.Update, data):
+        if event.callback_query:
+            user = event.callback_query.from_user
+        elif event.message:
+            user = event.message.from_user
+        else:
+            user = None
+        if user is None:
+            return await handler(event, data)
+        if user.id in ADMIN_IDS and user.id not in REVIEW_SESSIONS and user.id not in PENDING_EDITS:
+            return await handler(event, data)
+
+        dedup_key = None
+        if event.callback_query:
+            dedup_key = (user.id, event.callback_query.data or "")
+            if dedup_key in _INFLIGHT_CALLBACKS:
+                try:
+                    await event.callback_query.answer("Уже обрабатывается…")
+                except Exception:
+                    pass
+                return None
+
+        if USER_LOCKS.pending(user.id) >= MAX_UPDATES_PER_USER_QUEUE:
+            logger.warning("Too many queued updates for user %s, dropping update %s", user.id, event.update_id)
+            if event.callback_query:
+                try:
+                    await event.callback_query.answer("Слишком много запросов, подождите немного.")
+                except Exception:
+                    pass
+            else:
+                await _reply_busy(event.message, "Слишком много сообщений подряд, подождите немного и отправьте ещё раз.")
+            return None
+
+        if dedup_key:
+            _INFLIGHT_CALLBACKS.add(dedup_key)
+        try:
+            with _span("user_lock.wait"):
+                await USER_LOCKS.acquire(user.id)
+            try:
+                return await handler(event, data)
+            finally:
+                USER_LOCKS.release(user.id)
+        finally:
+            if dedup_key:
+                _INFLIGHT_CALLBACKS.discard(dedup_key)
+
+DB_PATH = os.getenv("DB_PATH", "reviews.db")
+
+# ---- restore ----
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def restore_backup(path: str):
+    """
+    Restores the database from a snapshot made by _make_backup.
+    Run with the bot stopped: python main.py restore backups/reviews-....db
+    """
+    checksum_path = path + ".sha256"
+    if os.path.exists(checksum_path):
+        with open(checksum_path, encoding="utf-8") as f:
+            expected = f.read().split()[0]
+        if _file_sha256(path) != expected:
+            raise RuntimeError(f"Checksum mismatch for {path}")
+    else:
+        logger.warning("No checksum file for %s, restoring without verification", path)
+
+    src = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    dst = sqlite3.connect(DB_PATH)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    logger.info("Database %s restored from %s", DB_PATH, path)
+
+# command-line tools run before the bot and the database are set up, so they
+# never run migrations on (or hold) the live database
+if __name__ == "__main__" and len(sys.argv) >= 2:
+    if sys.argv[1] == "traces":
+        print_trace_report(
+            sys.argv[2] if len(sys.argv) > 2 else TRACE_LOG_PATH,
+            int(sys.argv[3]) if len(sys.argv) > 3 else 10,
+        )
+        sys.exit(0)
+    if len(sys.argv) == 3 and sys.argv[1] == "restore":
+        restore_backup(sys.argv[2])
+        sys.exit(0)
+
 bot = Bot(token=BOT_TOKEN)
+bot.session.middleware(TracingRequestMiddleware())
+bot.session.middleware(ResilienceMiddleware())
 dp = Dispatcher()
+dp.update.outer_middleware(TracingMiddleware())
+dp.update.outer_middleware(UserSerializationMiddleware())
+dp.update.outer_middleware(AdmissionMiddleware())
 
-conn = sqlite3.connect("reviews.db", check_same_thread=False)
+conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=TracedConnection)
 cursor = conn.cursor()
+# WAL: readers (backups, exports) work from a snapshot and never block the bot's writes
+cursor.execute("PRAGMA journal_mode=WAL")
 cursor.execute("""
 CREATE TABLE IF NOT EXISTS reviews (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -37,17 +695,179 @@ CREATE TABLE IF NOT EXISTS reviews (
     created_at TEXT
 )
 """)
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS reviews_archive (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    username TEXT,
+    rating INTEGER,
+    text TEXT,
+    attachments TEXT,
+    status TEXT,
+    admin_id INTEGER,
+    moderation_date TEXT,
+    created_at TEXT,
+    archived_at TEXT
+)
+""")
+def _ensure_column(table: str, column: str, decl: str):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [r[1] for r in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+# moderation concurrency: version is bumped on every moderation write,
+# claimed_by/claimed_at mark an admin who is editing the review
+_ensure_column("reviews", "version", "INTEGER NOT NULL DEFAULT 0")
+_ensure_column("reviews", "claimed_by", "INTEGER")
+_ensure_column("reviews", "claimed_at", "TEXT")
+# likely duplicate found at submission time and its estimated similarity
+_ensure_column("reviews", "duplicate_of", "INTEGER")
+_ensure_column("reviews", "duplicate_score", "REAL")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS admin_messages (
+    review_id INTEGER,
+    chat_id INTEGER,
+    message_id INTEGER,
+    kind TEXT,
+    PRIMARY KEY (chat_id, message_id)
+)
+""")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_messages_review ON admin_messages (review_id)")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT UNIQUE,
+    kind TEXT,
+    chat_id INTEGER,
+    payload TEXT,
+    status TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TEXT,
+    last_error TEXT,
+    created_at TEXT,
+    sent_at TEXT
+)
+""")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS review_signatures (
+    review_id INTEGER PRIMARY KEY,
+    signature BLOB
+)
+""")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS review_lsh (
+    band INTEGER,
+    bucket INTEGER,
+    review_id INTEGER
+)
+""")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_review_lsh_bucket ON review_lsh (band, bucket)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_review_lsh_review ON review_lsh (review_id)")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS review_files (
+    file_unique_id TEXT,
+    review_id INTEGER
+)
+""")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_review_files_uid ON review_files (file_unique_id)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_review_files_review ON review_files (review_id)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_reviews_status_created ON reviews (status, created_at)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_reviews_status_moderated ON reviews (status, COALESCE(moderation_date, created_at))")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_reviews_user ON reviews (user_id)")
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_reviews_archive_user ON reviews_archive (user_id)")
 conn.commit()
 
+# incremental auto_vacuum lets the retention job return freed pages in small steps;
+# switching an existing database over requires one full VACUUM
+cursor.execute("PRAGMA auto_vacuum")
+if cursor.fetchone()[0] != 2:
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute("VACUUM")
+
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_REJECTED_DAYS = int(os.getenv("RETENTION_REJECTED_DAYS", "30"))
+RETENTION_APPROVED_DAYS = int(os.getenv("RETENTION_APPROVED_DAYS", "0"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "100"))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.05"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "200"))
+
+_ARCHIVE_COLUMNS = "id, user_id, username, rating, text, attachments, status, admin_id, moderation_date, created_at"
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "500"))
+EXPORT_COLUMNS = ["id", "user_id", "username", "rating", "text", "attachments", "status", "admin_id", "moderation_date", "created_at"]
+# every exported row also says whether it came from reviews_archive
+EXPORT_HEADER = EXPORT_COLUMNS + ["archived"]
+EXPORT_LOCK = asyncio.Lock()
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL_SECONDS = int(os.getenv("BACKUP_INTERVAL_SECONDS", "21600"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_LOCK = asyncio.Lock()
+BACKUP_STATE: Dict[str, object] = {
+    "running": False,
+    "last_path": None,
+    "last_sha256": None,
+    "last_size": None,
+    "last_duration": None,
+    "last_finished": None,
+    "last_error": None,
+}
+
+CLAIM_TTL_SECONDS = int(os.getenv("CLAIM_TTL_SECONDS", "300"))
+ADMIN_SYNC_EDIT_INTERVAL = float(os.getenv("ADMIN_SYNC_EDIT_INTERVAL", "0.05"))
+ADMIN_SYNC_RETRY_SECONDS = float(os.getenv("ADMIN_SYNC_RETRY_SECONDS", "5"))
+ADMIN_SYNC_MAX_ATTEMPTS = int(os.getenv("ADMIN_SYNC_MAX_ATTEMPTS", "8"))
+# digest mode: if ADMIN_DIGEST_THRESHOLD or more reviews arrive within
+# ADMIN_DIGEST_WINDOW_SECONDS, admins get one summary per window instead of
+# one message per review; 0 disables
+ADMIN_DIGEST_WINDOW_SECONDS = int(os.getenv("ADMIN_DIGEST_WINDOW_SECONDS", "0"))
+ADMIN_DIGEST_THRESHOLD = int(os.getenv("ADMIN_DIGEST_THRESHOLD", "10"))
+DIGEST_PAGE_SIZE = 8
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "5"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+# "flag" marks likely duplicates in the admin alert, "hold" also keeps them
+# out of the moderation queue (status 'held')
+DUPLICATE_ACTION = os.getenv("DUPLICATE_ACTION", "flag")
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.8"))
+# texts with fewer character 5-grams (about 45 letters) are too generic to
+# compare: "Всё супер, спасибо!" from two people is not a duplicate
+DUPLICATE_MIN_SHINGLES = int(os.getenv("DUPLICATE_MIN_SHINGLES", "40"))
+# changing these invalidates stored signatures
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+SIMILARITY_BACKFILL_BATCH = int(os.getenv("SIMILARITY_BACKFILL_BATCH", "200"))
+SIMILARITY_BACKFILL_PAUSE = float(os.getenv("SIMILARITY_BACKFILL_PAUSE", "0.2"))
+
 REVIEW_SESSIONS: Dict[int, Dict] = {}
 PENDING_EDITS: Dict[int, tuple] = {}
 
 LAST_BOT_MESSAGE_BY_CHAT: Dict[int, int] = {}
 
+ADMIN_NAMES: Dict[int, str] = {}
+
+# file_id -> file_unique_id of recently received attachments, used for
+# duplicate detection (file_id differs between bots/uploads, unique id does not)
+_FILE_UNIQUE_IDS: "OrderedDict[str, str]" = OrderedDict()
+_FILE_UNIQUE_IDS_MAX = 10000
+
+_SUBMISSION_TIMES: "deque[float]" = deque()
+OUTBOX_WAKEUP = asyncio.Event()
+
+# (review_id, sequence, text, reply_markup, (chat_id, message_id) of the copy to skip, attempt)
+ADMIN_SYNC_QUEUE: "asyncio.Queue[Tuple[int, int, str, Optional[InlineKeyboardMarkup], Optional[Tuple[int, int]], int]]" = asyncio.Queue()
+# review_id -> sequence of its latest sync; an older item being retried is dropped
+_ADMIN_SYNC_SEQ: Dict[int, int] = {}
+_admin_sync_counter = itertools.count(1)
+
 STATUS_EMOJI = {
     "pending": "⏳",
     "approved": "✅",
-    "rejected": "❌"
+    "rejected": "❌",
+    "held": "🔁"
 }
 
 # ---- helper keyboards ----
@@ -66,15 +886,19 @@ def rating_kb() -> InlineKeyboardMarkup:
     ])
     return kb
 
-def admin_keyboard(review_id: int) -> InlineKeyboardMarkup:
+def admin_keyboard(review_id: int, version: int) -> InlineKeyboardMarkup:
+    """
+    version is the reviews.version the admin is looking at; moderation
+    callbacks only apply if it is still current
+    """
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="✅ Опубликовать", callback_data=f"approve_{review_id}"),
-            InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_{review_id}")
+            InlineKeyboardButton(text="✅ Опубликовать", callback_data=f"approve_{review_id}_{version}"),
+            InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_{review_id}_{version}")
         ],
         [
             InlineKeyboardButton(text="✏️ Редактировать", callback_data=f"edit_{review_id}"),
-            InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_{review_id}")
+            InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_{review_id}_{version}")
         ]
     ])
     return kb
@@ -127,35 +951,385 @@ async def _store_last_bot_message(chat_id: int, message_obj: types.Message):
     except Exception:
         logger.exception("Failed to store last bot message for chat %s", chat_id)
 
-async def add_review_to_db(user_id: int, username: str, rating: int, text_body: str, attachments_list: Optional[List[Tuple[str, str]]] = None) -> int:
+# ---- moderation claims ----
+def _remember_admin(user: types.User):
+    ADMIN_NAMES[user.id] = user.username or user.full_name
+
+def _admin_display(admin_id: int) -> str:
+    name = ADMIN_NAMES.get(admin_id)
+    return f"@{name}" if name else f"#{admin_id}"
+
+def _reopen_review_kb(rid: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Открыть заново", callback_data=f"admin_review_{rid}")]
+    ])
+
+def _parse_moderation_data(data: str) -> Tuple[int, Optional[int]]:
+    """
+    "approve_<rid>_<version>" -> (rid, version)
+    "approve_<rid>" (buttons sent before versioning) -> (rid, None)
+    """
+    parts = data.split("_")
+    rid = int(parts[1])
+    version = int(parts[2]) if len(parts) > 2 else None
+    return rid, version
+
+def _claim_cutoff() -> str:
+    return (datetime.utcnow() - timedelta(seconds=CLAIM_TTL_SECONDS)).isoformat(sep=' ', timespec='seconds')
+
+_CLAIM_FREE_SQL = "(claimed_by IS NULL OR claimed_by = ? OR claimed_at < ?)"
+
+def _claim_review(rid: int, admin_id: int) -> bool:
+    """
+    Atomically takes (or refreshes) the claim on a review. Fails if another
+    admin holds a claim younger than CLAIM_TTL_SECONDS.
+    """
+    now = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
     cursor.execute(
-        "SELECT COUNT(*) FROM reviews WHERE user_id = ?",
-        (user_id,)
+        f"UPDATE reviews SET claimed_by = ?, claimed_at = ? WHERE id = ? AND {_CLAIM_FREE_SQL}",
+        (admin_id, now, rid, admin_id, _claim_cutoff())
     )
-    count = cursor.fetchone()[0]
+    conn.commit()
+    return cursor.rowcount == 1
+
+def _release_claim(rid: int, admin_id: int):
+    """
+    Drops the admin's claim on a review, if they still hold it.
+    """
+    cursor.execute("UPDATE reviews SET claimed_by = NULL, claimed_at = NULL WHERE id = ? AND claimed_by = ?", (rid, admin_id))
+    conn.commit()
+
+def _set_review_status(rid: int, version: Optional[int], admin_id: int, status: str, author_text: str) -> bool:
+    """
+    Compare-and-set moderation: succeeds only if nobody else moderated the
+    review since the admin saw `version` and no other admin holds a claim.
+    Legacy buttons without a version may only moderate pending reviews.
+    On success `author_text` is queued in the outbox in the same transaction.
+    """
+    now = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
+    guard = "version = ?" if version is not None else "status = 'pending'"
+    params = [status, admin_id, now, rid, admin_id, _claim_cutoff()]
+    if version is not None:
+        params.append(version)
+    cursor.execute(
+        "UPDATE reviews SET status = ?, admin_id = ?, moderation_date = ?, version = version + 1, "
+        f"claimed_by = NULL, claimed_at = NULL WHERE id = ? AND {_CLAIM_FREE_SQL} AND {guard}",
+        params
+    )
+    if cursor.rowcount != 1:
+        conn.commit()
+        return False
+    row = conn.execute("SELECT user_id, version FROM reviews WHERE id = ?", (rid,)).fetchone()
+    if row and row[0]:
+        _outbox_put(f"author:{rid}:{status}:{row[1]}", "text", row[0], {"text": author_text})
+    conn.commit()
+    _kick_outbox()
+    return True
+
+def _moderation_conflict_text(rid: int, admin_id: int) -> str:
+    cursor.execute("SELECT status, admin_id, claimed_by, claimed_at FROM reviews WHERE id = ?", (rid,))
+    row = cursor.fetchone()
+    if not row:
+        return "Отзыв уже удалён."
+    status, moderated_by, claimed_by, claimed_at = row
+    if claimed_by and claimed_by != admin_id and (claimed_at or "") >= _claim_cutoff():
+        return f"Отзыв сейчас редактирует администратор {_admin_display(claimed_by)}."
+    if status in ("pending", "held"):
+        # still waiting for a decision: it was edited since this copy was sent
+        if moderated_by:
+            return f"Отзыв изменён администратором {_admin_display(moderated_by)} после того, как вы его открыли. Откройте его заново."
+        return "Отзыв изменён после того, как вы его открыли. Откройте его заново."
+    status_icon = STATUS_EMOJI.get(status, status)
+    if not moderated_by:
+        return f"Отзыв уже обработан ({status_icon})."
+    return f"Отзыв уже обработан администратором {_admin_display(moderated_by)} ({status_icon})."
+
+async def _answer_moderation_conflict(query: CallbackQuery, rid: int):
+    """
+    Explains why a moderation tap lost. If the review is still undecided and
+    nobody else is editing it, the stale buttons are replaced with a reopen button.
+    """
+    await query.answer(_moderation_conflict_text(rid, query.from_user.id), show_alert=True)
+    row = conn.execute(
+        f"SELECT 1 FROM reviews WHERE id = ? AND status IN ('pending', 'held') AND {_CLAIM_FREE_SQL}",
+        (rid, query.from_user.id, _claim_cutoff())
+    ).fetchone()
+    if row and query.message:
+        try:
+            await query.message.edit_reply_markup(reply_markup=_reopen_review_kb(rid))
+        except TelegramBadRequest:
+            pass
+
+# ---- admin message sync ----
+def _record_admin_message(rid: int, msg: Optional[types.Message]):
+    """
+    Remembers a message with moderation buttons for review `rid`, so it can
+    be updated once any admin acts on the review.
+    """
+    if not msg:
+        return
+    kind = "text" if msg.text is not None else "caption"
+    cursor.execute(
+        "INSERT OR REPLACE INTO admin_messages (review_id, chat_id, message_id, kind) VALUES (?, ?, ?, ?)",
+        (rid, msg.chat.id, msg.message_id, kind)
+    )
+    conn.commit()
+
+def _sync_admin_messages(rid: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, skip: Optional[types.Message] = None):
+    """
+    Schedules an in-place edit of every recorded admin copy of review `rid`
+    (except `skip`, which the acting handler edits itself).
+    """
+    skip_key = (skip.chat.id, skip.message_id) if skip else None
+    seq = _ADMIN_SYNC_SEQ[rid] = next(_admin_sync_counter)
+    ADMIN_SYNC_QUEUE.put_nowait((rid, seq, text, reply_markup, skip_key, 0))
+
+async def _edit_admin_message(chat_id: int, message_id: int, kind: str, text: str, reply_markup: Optional[InlineKeyboardMarkup]):
+    try:
+        if kind == "text":
+            await bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+        else:
+            await bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=text, reply_markup=reply_markup)
+    except TelegramBadRequest:
+        # deleted by the admin or already up to date
+        logger.debug("Could not edit admin message %s in chat %s", message_id, chat_id)
+
+async def admin_sync_worker():
+    """
+    Drains ADMIN_SYNC_QUEUE, editing at most one message per
+    ADMIN_SYNC_EDIT_INTERVAL to stay under Telegram flood limits.
+    A copy is forgotten only once its edit went through (or Telegram refused
+    it for good); if the API is unavailable or the call is shed, the rest of
+    the item is queued again with a growing delay.
+    """
+    API_CRITICAL.set(False)
+    loop = asyncio.get_running_loop()
+    while True:
+        rid, seq, text, reply_markup, skip_key, attempt = await ADMIN_SYNC_QUEUE.get()
+        try:
+            if _ADMIN_SYNC_SEQ.get(rid) != seq:
+                # a newer sync for this review covers the same copies
+                continue
+            # nothing left to moderate once the review itself is gone
+            conn.execute("DELETE FROM admin_messages WHERE review_id = ? AND NOT EXISTS (SELECT 1 FROM reviews WHERE id = ?)", (rid, rid))
+            conn.commit()
+            rows = conn.execute("SELECT chat_id, message_id, kind FROM admin_messages WHERE review_id = ?", (rid,)).fetchall()
+            rows = [r for r in rows if (r[0], r[1]) != skip_key]
+            error: Optional[Exception] = None
+            for chat_id, message_id, kind in rows:
+                try:
+                    async with ADMISSION.slot():
+                        await _edit_admin_message(chat_id, message_id, kind, text, reply_markup)
+                except TelegramForbiddenError:
+                    # the admin blocked the bot, the copy can't be reached any more
+                    pass
+                except Exception as e:
+                    error = e
+                    break
+                conn.execute("DELETE FROM admin_messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+                conn.commit()
+                await asyncio.sleep(ADMIN_SYNC_EDIT_INTERVAL)
+            if error is None:
+                if _ADMIN_SYNC_SEQ.get(rid) == seq:
+                    del _ADMIN_SYNC_SEQ[rid]
+            elif attempt + 1 >= ADMIN_SYNC_MAX_ATTEMPTS:
+                logger.error("Giving up syncing admin messages of review %s after %s attempts: %s", rid, attempt + 1, error)
+            else:
+                delay = min(600, ADMIN_SYNC_RETRY_SECONDS * (2 ** attempt))
+                if isinstance(error, (CircuitOpenError, TelegramNetworkError, TelegramServerError, TelegramRetryAfter, asyncio.TimeoutError)):
+                    logger.warning("Admin message sync for review %s postponed %.1fs: %s", rid, delay, type(error).__name__)
+                else:
+                    logger.error("Admin message sync for review %s failed, retry in %.1fs", rid, delay, exc_info=error)
+                loop.call_later(delay, ADMIN_SYNC_QUEUE.put_nowait, (rid, seq, text, reply_markup, skip_key, attempt + 1))
+        except Exception:
+            logger.exception("Admin message sync failed for review %s", rid)
+        finally:
+            ADMIN_SYNC_QUEUE.task_done()
+
+def _review_version(rid: int) -> int:
+    cursor.execute("SELECT version FROM reviews WHERE id = ?", (rid,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+# ---- duplicate detection ----
+_MERSENNE_61 = (1 << 61) - 1
+_rng = random.Random(20240601)
+_MINHASH_PARAMS = [(_rng.randrange(1, _MERSENNE_61), _rng.randrange(0, _MERSENNE_61)) for _ in range(MINHASH_PERMUTATIONS)]
+_LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+
+def _shingles(text: str, k: int = 5) -> Set[int]:
+    """
+    Character k-grams of the text with case, punctuation and extra spaces removed.
+    """
+    norm = " ".join(re.findall(r"\w+", (text or "").lower()))
+    if not norm:
+        return set()
+    if len(norm) <= k:
+        return {zlib.crc32(norm.encode("utf-8"))}
+    return {zlib.crc32(norm[i:i + k].encode("utf-8")) for i in range(len(norm) - k + 1)}
+
+def _minhash(text: str) -> Optional[Tuple[int, ...]]:
+    shingles = _shingles(text)
+    if not shingles:
+        return None
+    return tuple(min((a * x + b) % _MERSENNE_61 for x in shingles) for a, b in _MINHASH_PARAMS)
+
+def _lsh_buckets(sig: Tuple[int, ...]) -> List[Tuple[int, int]]:
+    buckets = []
+    for band in range(LSH_BANDS):
+        chunk = sig[band * _LSH_ROWS:(band + 1) * _LSH_ROWS]
+        digest = hashlib.blake2b(struct.pack(f"<{_LSH_ROWS}Q", *chunk), digest_size=8).digest()
+        buckets.append((band, struct.unpack("<q", digest)[0]))
+    return buckets
+
+def _unindex_review(rid: int):
+    """
+    Drops a review from the similarity index. Does not commit.
+    """
+    conn.execute("DELETE FROM review_signatures WHERE review_id = ?", (rid,))
+    conn.execute("DELETE FROM review_lsh WHERE review_id = ?", (rid,))
+    conn.execute("DELETE FROM review_files WHERE review_id = ?", (rid,))
+
+def _store_review_fingerprints(rid: int, sig: Optional[Tuple[int, ...]], file_uids: List[str]):
+    """
+    Persists fingerprints of a review. Does not commit.
+    """
+    if sig is not None:
+        conn.execute(
+            "INSERT OR REPLACE INTO review_signatures (review_id, signature) VALUES (?, ?)",
+            (rid, struct.pack(f"<{MINHASH_PERMUTATIONS}Q", *sig))
+        )
+        conn.executemany(
+            "INSERT INTO review_lsh (band, bucket, review_id) VALUES (?, ?, ?)",
+            [(band, bucket, rid) for band, bucket in _lsh_buckets(sig)]
+        )
+    if file_uids:
+        conn.executemany("INSERT INTO review_files (file_unique_id, review_id) VALUES (?, ?)", [(u, rid) for u in file_uids])
+
+def _reindex_review_text(rid: int, sig: Optional[Tuple[int, ...]]):
+    """
+    Replaces the text fingerprint of an edited review; attachment ids stay.
+    Does not commit.
+    """
+    conn.execute("DELETE FROM review_signatures WHERE review_id = ?", (rid,))
+    conn.execute("DELETE FROM review_lsh WHERE review_id = ?", (rid,))
+    _store_review_fingerprints(rid, sig, [])
+
+def _find_duplicate(sig: Optional[Tuple[int, ...]], file_uids: List[str]) -> Tuple[Optional[int], Optional[float]]:
+    """
+    Returns (review_id, similarity) of the most similar earlier review, or
+    (None, None). Same attachment = exact duplicate; otherwise only reviews
+    sharing an LSH bucket are compared, so cost does not grow with the table.
+    """
+    if file_uids:
+        placeholders = ",".join("?" * len(file_uids))
+        row = conn.execute(
+            f"SELECT review_id FROM review_files WHERE file_unique_id IN ({placeholders}) ORDER BY review_id LIMIT 1",
+            file_uids
+        ).fetchone()
+        if row:
+            return row[0], 1.0
+    if sig is None:
+        return None, None
+    buckets = _lsh_buckets(sig)
+    rows = conn.execute(
+        "SELECT s.review_id, s.signature FROM review_signatures s WHERE s.review_id IN ("
+        "SELECT review_id FROM review_lsh WHERE " + " OR ".join(["(band = ? AND bucket = ?)"] * len(buckets)) + ")",
+        [v for key in buckets for v in key]
+    ).fetchall()
+    best_id, best_score = None, 0.0
+    for cid, blob in rows:
+        other = struct.unpack(f"<{MINHASH_PERMUTATIONS}Q", blob)
+        score = sum(1 for x, y in zip(sig, other) if x == y) / MINHASH_PERMUTATIONS
+        if score > best_score or (score == best_score and best_id is not None and cid < best_id):
+            best_id, best_score = cid, score
+    if best_id is not None and best_score >= DUPLICATE_THRESHOLD:
+        return best_id, best_score
+    return None, None
+
+async def similarity_backfill_worker():
+    """
+    Fingerprints reviews created before duplicate detection existed, in
+    small batches with the hashing off the event loop. Until a review is
+    fingerprinted it simply never matches.
+    """
+    last_id = 0
+    done = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, text FROM reviews WHERE id > ? AND id NOT IN (SELECT review_id FROM review_signatures) ORDER BY id LIMIT ?",
+            (last_id, SIMILARITY_BACKFILL_BATCH)
+        ).fetchall()
+        if not rows:
+            break
+        sigs = await asyncio.to_thread(lambda: [(rid, _minhash(text_body)) for rid, text_body in rows])
+        async with ADMISSION.slot():
+            for rid, sig in sigs:
+                # the review may have been deleted or archived while we were hashing
+                if sig is not None and conn.execute("SELECT 1 FROM reviews WHERE id = ?", (rid,)).fetchone():
+                    _store_review_fingerprints(rid, sig, [])
+                    done += 1
+            conn.commit()
+        last_id = rows[-1][0]
+        await asyncio.sleep(SIMILARITY_BACKFILL_PAUSE)
+    if done:
+        logger.info("Similarity backfill: %s reviews fingerprinted", done)
+
+def _duplicate_note(duplicate_of: Optional[int], score: Optional[float]) -> str:
+    if not duplicate_of:
+        return ""
+    return f"⚠️ Похож на отзыв #{duplicate_of} ({round((score or 0) * 100)}%)\n"
+
+def _count_user_reviews(user_id: int) -> int:
+    """
+    archived reviews still count towards the per-user limit
+    """
+    cursor.execute(
+        "SELECT (SELECT COUNT(*) FROM reviews WHERE user_id = ?) + (SELECT COUNT(*) FROM reviews_archive WHERE user_id = ?)",
+        (user_id, user_id)
+    )
+    return cursor.fetchone()[0]
+
+async def add_review_to_db(user_id: int, username: str, rating: int, text_body: str, attachments_list: Optional[List[Tuple[str, str]]] = None) -> int:
+    count = _count_user_reviews(user_id)
     
     if count >= 2:
         raise ValueError("Превышен лимит отзывов (максимум 2 на пользователя)")
     
     created_at = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
     attachments_str = _attachments_to_str(attachments_list)
+    # up to a few tens of ms for a 2000-char text, keep it off the event loop
+    shingle_count, sig = await asyncio.to_thread(lambda: (len(_shingles(text_body)), _minhash(text_body)))
+    file_uids = [_FILE_UNIQUE_IDS[fid] for _, fid in (attachments_list or []) if fid in _FILE_UNIQUE_IDS]
+    # short texts are still stored, they just never count as a text match
+    duplicate_of, duplicate_score = _find_duplicate(sig if shingle_count >= DUPLICATE_MIN_SHINGLES else None, file_uids)
+    status = "held" if duplicate_of and DUPLICATE_ACTION == "hold" else "pending"
     cursor.execute(
-        "INSERT INTO reviews (user_id, username, rating, text, attachments, status, created_at) VALUES (?, ?, ?, ?, ?, 'pending', ?)",
-        (user_id, username, rating, text_body, attachments_str, created_at)
+        "INSERT INTO reviews (user_id, username, rating, text, attachments, status, created_at, duplicate_of, duplicate_score) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, username, rating, text_body, attachments_str, status, created_at, duplicate_of, duplicate_score)
     )
-    conn.commit()
     rid = cursor.lastrowid
-    await notify_admins_new_review(rid)
+    _store_review_fingerprints(rid, sig, file_uids)
+    if status == "pending":
+        for a in ADMIN_IDS:
+            _outbox_put(f"admin_review:{rid}:{a}", "admin_review", a, {"review_id": rid})
+    else:
+        logger.info("Review %s held as a likely duplicate of %s", rid, duplicate_of)
+    conn.commit()
+    _register_submission()
+    _kick_outbox()
     return rid
 
-async def _send_text_with_attachments_and_kb(chat_id: int, text: str, attachments: Optional[List[str]], kb: Optional[InlineKeyboardMarkup] = None):
+async def _send_text_with_attachments_and_kb(chat_id: int, text: str, attachments: Optional[List[str]], kb: Optional[InlineKeyboardMarkup] = None) -> Optional[types.Message]:
     """
     attachments: list of strings "type:fileid" (as stored in DB) or None
     First (main) attachment is sent with caption/text (if possible),
     extra attachments are sent afterwards without caption.
     Special handling for video_note: since it can't have caption, we send it first, then the text message.
     The function also replaces last bot message in the chat.
+    Returns the message carrying `kb` (None if sending failed).
     """
+    sent_msg = None
     attachments = attachments or []
     try:
         try:
@@ -168,7 +1342,7 @@ async def _send_text_with_attachments_and_kb(chat_id: int, text: str, attachment
         if not parsed:
             sent_msg = await bot.send_message(chat_id, text, reply_markup=kb)
             await _store_last_bot_message(chat_id, sent_msg)
-            return
+            return sent_msg
 
         first_type, first_fid = parsed[0]
         sent_msg = None
@@ -207,7 +1381,9 @@ async def _send_text_with_attachments_and_kb(chat_id: int, text: str, attachment
             else:
                 sent_msg = await bot.send_message(chat_id, text, reply_markup=kb)
                 await _store_last_bot_message(chat_id, sent_msg)
-        except Exception:
+        except TelegramBadRequest:
+            # media rejected (e.g. stale file_id) — fall back to plain text
+            logger.warning("Failed to send %s %s to %s, sending text only", first_type, first_fid, chat_id)
             sent_msg = await bot.send_message(chat_id, text, reply_markup=kb)
             await _store_last_bot_message(chat_id, sent_msg)
 
@@ -232,27 +1408,215 @@ async def _send_text_with_attachments_and_kb(chat_id: int, text: str, attachment
                     logger.exception("Failed to send extra attachment %s (%s) to %s", t, fid, chat_id)
     except Exception:
         logger.exception("Error while sending text+attachments to %s", chat_id)
+    return sent_msg
 
-async def notify_admins_new_review(rid: int):
-    try:
-        cursor.execute("SELECT id, user_id, username, rating, text, attachments, created_at FROM reviews WHERE id = ?", (rid,))
-        row = cursor.fetchone()
-        if not row:
-            return
-        _id, user_id, username, rating, text_body, attachments, created_at = row
+# ---- admin digest ----
+def _register_submission():
+    if ADMIN_DIGEST_WINDOW_SECONDS > 0:
+        _SUBMISSION_TIMES.append(time.monotonic())
+
+def _digest_active() -> bool:
+    """
+    Tells whether the recent submission rate is high enough to batch admin
+    notifications.
+    """
+    if ADMIN_DIGEST_WINDOW_SECONDS <= 0 or ADMIN_DIGEST_THRESHOLD <= 0:
+        return False
+    now = time.monotonic()
+    while _SUBMISSION_TIMES and _SUBMISSION_TIMES[0] < now - ADMIN_DIGEST_WINDOW_SECONDS:
+        _SUBMISSION_TIMES.popleft()
+    return len(_SUBMISSION_TIMES) >= ADMIN_DIGEST_THRESHOLD
+
+def _digest_page(page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    cursor.execute("SELECT COUNT(*) FROM reviews WHERE status = 'pending'")
+    total = cursor.fetchone()[0]
+    pages = max(1, (total + DIGEST_PAGE_SIZE - 1) // DIGEST_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    cursor.execute(
+        "SELECT id, username, rating FROM reviews WHERE status = 'pending' ORDER BY id LIMIT ? OFFSET ?",
+        (DIGEST_PAGE_SIZE, page * DIGEST_PAGE_SIZE)
+    )
+    kb_rows = []
+    for rid, username, rating in cursor.fetchall():
         author = username or "Аноним"
-        stars = "⭐" * int(rating)
-        text = f"🆕 Новый отзыв #{rid} — {stars}\nОт: @{author}\nДата: {created_at}\n\n{text_body}"
-        kb = admin_keyboard(rid)
+        kb_rows.append([InlineKeyboardButton(text=f"#{rid} — {rating}⭐ от {author}", callback_data=f"admin_review_{rid}")])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"digest_page_{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"digest_page_{page + 1}"))
+    if nav:
+        kb_rows.append(nav)
+    text = f"📬 Ожидают модерации: {total} (стр. {page + 1}/{pages})"
+    return text, InlineKeyboardMarkup(inline_keyboard=kb_rows)
+
+def _digest_due_at() -> str:
+    """
+    End of the current digest window; alerts folded now are summarised then.
+    """
+    due = (int(time.time()) // ADMIN_DIGEST_WINDOW_SECONDS + 1) * ADMIN_DIGEST_WINDOW_SECONDS
+    return datetime.utcfromtimestamp(due).isoformat(sep=' ', timespec='seconds')
 
-        for a in ADMIN_IDS:
-            try:
-                at_list = (attachments.split(',') if attachments else [])
-                await _send_text_with_attachments_and_kb(a, text, at_list, kb)
-            except Exception:
-                logger.exception("Failed to notify admin %s about review %s", a, rid)
-    except Exception:
-        logger.exception("Error in notify_admins_new_review for id=%s", rid)
+def _defer_to_digest(item_id: int, admin_id: int):
+    """
+    Folds an admin_review outbox item into the admin's digest for the current
+    window. Does not commit. The item stays in status 'digest' until the
+    digest is delivered, so a crash or a failed send loses nothing.
+    """
+    due_at = _digest_due_at()
+    _outbox_put(f"admin_digest:{admin_id}:{due_at}", "admin_digest", admin_id, {"due_at": due_at}, next_attempt_at=due_at)
+    conn.execute("UPDATE outbox SET status = 'digest', next_attempt_at = ? WHERE id = ?", (due_at, item_id))
+
+def _settle_digest(admin_id: int, due_at: str, delivered: bool):
+    """
+    Marks the alerts covered by a digest as sent, or, if the digest failed for
+    good, puts them back in the queue to be delivered one by one. Does not commit.
+    """
+    now = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
+    if delivered:
+        conn.execute(
+            "UPDATE outbox SET status = 'sent', sent_at = ? "
+            "WHERE kind = 'admin_review' AND chat_id = ? AND status = 'digest' AND next_attempt_at <= ?",
+            (now, admin_id, due_at)
+        )
+    else:
+        conn.execute(
+            "UPDATE outbox SET status = 'pending', next_attempt_at = ? "
+            "WHERE kind = 'admin_review' AND chat_id = ? AND status = 'digest' AND next_attempt_at <= ?",
+            (now, admin_id, due_at)
+        )
+
+async def _send_admin_digest(admin_id: int, due_at: str):
+    covered = conn.execute(
+        "SELECT COUNT(*) FROM outbox WHERE kind = 'admin_review' AND chat_id = ? AND status = 'digest' AND next_attempt_at <= ?",
+        (admin_id, due_at)
+    ).fetchone()[0]
+    if not covered:
+        return
+    page_text, kb = _digest_page(0)
+    text = f"🆕 Новых отзывов за {ADMIN_DIGEST_WINDOW_SECONDS} с: {covered}\n{page_text}"
+    await bot.send_message(admin_id, text, reply_markup=kb)
+
+async def notify_admin_new_review(admin_id: int, rid: int) -> bool:
+    """
+    Delivers the new-review alert for one admin (called by the outbox
+    worker). Raises if the alert could not be sent, so it is retried.
+    Returns False if the alert should go into the digest instead.
+    """
+    cursor.execute("SELECT id, user_id, username, rating, text, attachments, created_at, version, status, duplicate_of, duplicate_score FROM reviews WHERE id = ?", (rid,))
+    row = cursor.fetchone()
+    if not row:
+        return True
+    _id, user_id, username, rating, text_body, attachments, created_at, version, status, duplicate_of, duplicate_score = row
+    if status != "pending":
+        # already handled by someone while the alert was queued
+        return True
+    if _digest_active():
+        return False
+
+    author = username or "Аноним"
+    stars = "⭐" * int(rating)
+    text = f"🆕 Новый отзыв #{rid} — {stars}\nОт: @{author}\nДата: {created_at}\n{_duplicate_note(duplicate_of, duplicate_score)}\n{text_body}"
+    kb = admin_keyboard(rid, version)
+    at_list = (attachments.split(',') if attachments else [])
+    sent = await _send_text_with_attachments_and_kb(admin_id, text, at_list, kb)
+    if sent is None:
+        raise RuntimeError(f"Failed to notify admin {admin_id} about review {rid}")
+    _record_admin_message(rid, sent)
+    return True
+
+# ---- outbox ----
+def _outbox_put(key: str, kind: str, chat_id: int, payload: Dict, next_attempt_at: Optional[str] = None):
+    """
+    Queues a notification. Does not commit: call it inside the transaction
+    that makes the state change, so both are stored or neither is.
+    The idempotency key makes re-queuing the same notification a no-op.
+    """
+    now = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
+    conn.execute(
+        "INSERT OR IGNORE INTO outbox (idempotency_key, kind, chat_id, payload, status, next_attempt_at, created_at) "
+        "VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+        (key, kind, chat_id, json.dumps(payload, ensure_ascii=False), next_attempt_at or now, now)
+    )
+
+def _kick_outbox():
+    OUTBOX_WAKEUP.set()
+
+async def _deliver_outbox_item(item_id: int, kind: str, chat_id: int, payload: Dict) -> bool:
+    """
+    Returns False if the item was folded into a digest and stays unsent.
+    """
+    if kind == "text":
+        await bot.send_message(chat_id, payload["text"])
+    elif kind == "admin_review":
+        if not await notify_admin_new_review(chat_id, payload["review_id"]):
+            _defer_to_digest(item_id, chat_id)
+            return False
+    elif kind == "admin_digest":
+        await _send_admin_digest(chat_id, payload["due_at"])
+    else:
+        raise ValueError(f"Unknown outbox kind {kind}")
+    return True
+
+async def _drain_outbox_batch() -> int:
+    now = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
+    rows = conn.execute(
+        "SELECT id, kind, chat_id, payload, attempts FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+        (now, OUTBOX_BATCH_SIZE)
+    ).fetchall()
+    for item_id, kind, chat_id, raw_payload, attempts in rows:
+        payload: Dict = {}
+        try:
+            payload = json.loads(raw_payload)
+            async with ADMISSION.slot():
+                delivered = await _deliver_outbox_item(item_id, kind, chat_id, payload)
+        except (TelegramForbiddenError, TelegramBadRequest, ValueError) as e:
+            # user blocked the bot, chat is gone, or the item is malformed: retrying won't help
+            logger.warning("Outbox item %s dropped: %s", item_id, e)
+            conn.execute("UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?", (str(e), item_id))
+            if kind == "admin_digest" and "due_at" in payload:
+                _settle_digest(chat_id, payload["due_at"], delivered=False)
+        except Exception as e:
+            attempts += 1
+            status = "failed" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+            delay = min(3600, OUTBOX_RETRY_BASE_SECONDS * (2 ** attempts)) * random.uniform(0.5, 1.0)
+            next_at = (datetime.utcnow() + timedelta(seconds=delay)).isoformat(sep=' ', timespec='seconds')
+            logger.warning("Outbox item %s failed (attempt %s): %s", item_id, attempts, e)
+            conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (status, attempts, next_at, str(e), item_id)
+            )
+            if kind == "admin_digest" and status == "failed":
+                _settle_digest(chat_id, payload["due_at"], delivered=False)
+        else:
+            if delivered:
+                sent_at = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
+                conn.execute("UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = ? WHERE id = ?", (sent_at, item_id))
+                if kind == "admin_digest":
+                    _settle_digest(chat_id, payload["due_at"], delivered=True)
+        conn.commit()
+    return len(rows)
+
+async def outbox_worker():
+    """
+    Delivers queued notifications. Woken right after a commit that queued
+    something, and every OUTBOX_POLL_SECONDS for retries and for items left
+    over from a previous run. Delivery is at-least-once: a crash between a
+    send and its 'sent' mark repeats that one message.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(OUTBOX_WAKEUP.wait(), OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        OUTBOX_WAKEUP.clear()
+        try:
+            while await _drain_outbox_batch() == OUTBOX_BATCH_SIZE:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Outbox worker failed")
 
 async def _send_step_message(uid: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
     try:
@@ -263,11 +1627,8 @@ async def _send_step_message(uid: int, text: str, reply_markup: Optional[InlineK
     try:
         msg = await bot.send_message(uid, text, reply_markup=reply_markup)
     except Exception:
-        try:
-            msg = await bot.send_message(uid, text, reply_markup=reply_markup)
-        except Exception:
-            logger.exception("Failed to send step message to %s", uid)
-            return None
+        logger.exception("Failed to send step message to %s", uid)
+        return None
 
     await _store_last_bot_message(uid, msg)
     session = REVIEW_SESSIONS.get(uid)
@@ -289,12 +1650,21 @@ async def cmd_start(message: Message):
     await message.answer("Привет! Я бот для приёма отзывов. Выбери действие:", reply_markup=main_menu_kb())
 
 @dp.message(Command("admin"))
-async def cmd_admin_panel(message: Message):
+async def cmd_admin_panel(message: Message, command: CommandObject):
     if message.from_user.id not in ADMIN_IDS:
         await message.reply("Только для администраторов.")
         return
 
-    cursor.execute("SELECT id, username, rating, status FROM reviews ORDER BY created_at DESC LIMIT 50")
+    if (command.args or "").strip().lower() == "held":
+        # held reviews get no alert, so they are listed oldest first until handled
+        cursor.execute("SELECT id, username, rating, status FROM reviews WHERE status = 'held' ORDER BY created_at LIMIT 50")
+        title = "Задержанные как дубликаты — выберите отзыв:"
+    else:
+        held = conn.execute("SELECT COUNT(*) FROM reviews WHERE status = 'held'").fetchone()[0]
+        cursor.execute("SELECT id, username, rating, status FROM reviews ORDER BY created_at DESC LIMIT 50")
+        title = "Админ-панель — выберите отзыв:"
+        if held:
+            title += f"\n🔁 Задержано как дубликаты: {held} (/admin held)"
     rows = cursor.fetchall()
     if not rows:
         await message.reply("Нет отзывов для модерации.")
@@ -315,14 +1685,133 @@ async def cmd_admin_panel(message: Message):
     except Exception:
         pass
 
-    sent = await bot.send_message(message.chat.id, "Админ-панель — выберите отзыв:", reply_markup=kb)
+    sent = await bot.send_message(message.chat.id, title, reply_markup=kb)
     await _store_last_bot_message(message.chat.id, sent)
 
+def _iter_review_rows(status: Optional[str], since: Optional[str], chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[List[tuple]]:
+    """
+    Yields rows of `reviews`, then of `reviews_archive`, in chunks of
+    `chunk_size`, ordered by id within each table; the last column is 1 for
+    archived rows. Uses its own read-only connection and keyset pagination,
+    so no read lock is held between chunks and the bot's connection is
+    never touched.
+    """
+    src = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    try:
+        where = ["id > ?"]
+        base_params: List = []
+        if status:
+            where.append("status = ?")
+            base_params.append(status)
+        if since:
+            where.append("created_at >= ?")
+            base_params.append(since)
+        for table, archived in (("reviews", 0), ("reviews_archive", 1)):
+            query = f"SELECT {', '.join(EXPORT_COLUMNS)}, {archived} FROM {table} WHERE {' AND '.join(where)} ORDER BY id LIMIT ?"
+            last_id = 0
+            while True:
+                rows = src.execute(query, (last_id, *base_params, chunk_size)).fetchall()
+                if not rows:
+                    break
+                yield rows
+                if len(rows) < chunk_size:
+                    break
+                last_id = rows[-1][0]
+    finally:
+        src.close()
+
+def _write_export(path: str, fmt: str, status: Optional[str], since: Optional[str]) -> int:
+    """
+    fmt: "csv" or "jsonl" (gzipped). Returns number of exported rows.
+    """
+    count = 0
+    if fmt == "csv":
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_HEADER)
+            for chunk in _iter_review_rows(status, since):
+                writer.writerows(chunk)
+                count += len(chunk)
+    else:
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            for chunk in _iter_review_rows(status, since):
+                for row in chunk:
+                    f.write(json.dumps(dict(zip(EXPORT_HEADER, row)), ensure_ascii=False))
+                    f.write("\n")
+                count += len(chunk)
+    return count
+
+def _parse_export_args(args: Optional[str]) -> Tuple[Optional[str], Optional[str], str]:
+    """
+    "/export [status] [since] [csv|jsonl]" in any order.
+    status: pending/approved/rejected/all, since: YYYY-MM-DD
+    """
+    status, since, fmt = None, None, "csv"
+    for tok in (args or "").split():
+        tok = tok.strip().lower()
+        if tok in ("csv", "jsonl"):
+            fmt = tok
+        elif tok == "all":
+            status = None
+        elif tok in STATUS_EMOJI:
+            status = tok
+        else:
+            since = datetime.strptime(tok, "%Y-%m-%d").strftime("%Y-%m-%d")
+    return status, since, fmt
+
+@dp.message(Command("export"))
+async def cmd_export(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply("Только для администраторов.")
+        return
+    try:
+        status, since, fmt = _parse_export_args(command.args)
+    except ValueError:
+        await message.reply("Использование: /export [pending|approved|rejected|all] [ГГГГ-ММ-ДД] [csv|jsonl]")
+        return
+    if EXPORT_LOCK.locked():
+        await message.reply("Экспорт уже выполняется, попробуйте позже.")
+        return
+
+    suffix = ".csv" if fmt == "csv" else ".jsonl.gz"
+    fd, path = tempfile.mkstemp(prefix="reviews_export_", suffix=suffix)
+    os.close(fd)
+    try:
+        async with EXPORT_LOCK:
+            count = await asyncio.to_thread(_write_export, path, fmt, status, since)
+        filename = f"reviews_{status or 'all'}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}{suffix}"
+        await bot.send_document(message.chat.id, FSInputFile(path, filename=filename), caption=f"Экспортировано отзывов: {count}",
+            request_timeout=int(API_UPLOAD_TIMEOUT))
+    except Exception:
+        logger.exception("Export failed for admin %s", message.from_user.id)
+        await message.reply("Ошибка при экспорте.")
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+@dp.message(Command("backup"))
+async def cmd_backup(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply("Только для администраторов.")
+        return
+    if (command.args or "").strip().lower() == "status" or BACKUP_LOCK.locked():
+        await message.reply(_backup_status_text())
+        return
+    await message.reply("Создаю резервную копию...")
+    await run_backup()
+    await message.reply(_backup_status_text())
+
 @dp.callback_query(F.data == "admin_close")
 async def cb_admin_close(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         await query.answer("Только для администраторов.")
         return
+    # closing the panel abandons an edit in progress
+    pending = PENDING_EDITS.pop(query.from_user.id, None)
+    if pending:
+        _release_claim(pending[0], query.from_user.id)
     try:
         await query.message.delete()
     except Exception:
@@ -350,10 +1839,7 @@ async def cb_list_reviews(query: CallbackQuery):
 
     review_buttons.append([InlineKeyboardButton(text="Назад", callback_data="main_menu")])
     kb = InlineKeyboardMarkup(inline_keyboard=review_buttons)
-    try:
-        await query.message.answer("Выберите отзыв:", reply_markup=kb)
-    except Exception:
-        await query.message.answer("Выберите отзыв:", reply_markup=kb)
+    await query.message.answer("Выберите отзыв:", reply_markup=kb)
     await query.answer()
 
 
@@ -368,13 +1854,13 @@ async def cb_admin_review_open(query: CallbackQuery):
         await query.answer("Некорректный ID отзыва.")
         return
 
-    cursor.execute("SELECT username, rating, text, attachments, created_at, status FROM reviews WHERE id = ?", (review_id,))
+    cursor.execute("SELECT username, rating, text, attachments, created_at, status, version, duplicate_of, duplicate_score FROM reviews WHERE id = ?", (review_id,))
     row = cursor.fetchone()
     if not row:
         await query.answer("Отзыв не найден.")
         return
 
-    username, rating, text_body, attachments, created_at, status = row
+    username, rating, text_body, attachments, created_at, status, version, duplicate_of, duplicate_score = row
     author = username or "Аноним"
     stars = "⭐" * int(rating)
     status_icon = STATUS_EMOJI.get(status, status)
@@ -383,12 +1869,31 @@ async def cb_admin_review_open(query: CallbackQuery):
         f"От: {author}\n"
         f"Оценка: {stars}\n"
         f"Статус: {status_icon}\n"
-        f"Дата: {created_at}\n\n"
+        f"Дата: {created_at}\n"
+        f"{_duplicate_note(duplicate_of, duplicate_score)}\n"
         f"{text_body or ''}"
     )
-    kb = admin_keyboard(review_id)
+    kb = admin_keyboard(review_id, version)
     at_list = (attachments.split(',') if attachments else [])
-    await _send_text_with_attachments_and_kb(query.from_user.id, review_text, at_list, kb)
+    sent = await _send_text_with_attachments_and_kb(query.from_user.id, review_text, at_list, kb)
+    _record_admin_message(review_id, sent)
+    await query.answer()
+
+@dp.callback_query(F.data.startswith("digest_page_"))
+async def cb_digest_page(query: CallbackQuery):
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer("Только для администраторов.", show_alert=True)
+        return
+    try:
+        page = int(query.data.split("_")[2])
+    except Exception:
+        await query.answer("Некорректная страница.")
+        return
+    text, kb = _digest_page(page)
+    try:
+        await query.message.edit_text(text, reply_markup=kb)
+    except Exception:
+        logger.debug("Could not edit digest message in chat %s", query.message.chat.id)
     await query.answer()
 
 @dp.callback_query(F.data.startswith("review_"))
@@ -434,11 +1939,7 @@ async def cb_main_menu(query: CallbackQuery):
 async def cb_leave_review(query: CallbackQuery):
     uid = query.from_user.id
     
-    cursor.execute(
-        "SELECT COUNT(*) FROM reviews WHERE user_id = ?",
-        (uid,)
-    )
-    count = cursor.fetchone()[0]
+    count = _count_user_reviews(uid)
     
     if count >= 2:
         await query.answer("Вы уже оставили максимальное количество отзывов (2).", show_alert=True)
@@ -477,18 +1978,24 @@ def _gather_attachments_from_message(message: Message) -> List[Tuple[str, str]]:
     """
     res: List[Tuple[str, str]] = []
     try:
+        files = []
         if message.photo:
-            res.append(("photo", message.photo[-1].file_id))
+            files.append(("photo", message.photo[-1]))
         if message.video:
-            res.append(("video", message.video.file_id))
+            files.append(("video", message.video))
         if getattr(message, "video_note", None):
-            res.append(("video_note", message.video_note.file_id))
+            files.append(("video_note", message.video_note))
         if message.voice:
-            res.append(("voice", message.voice.file_id))
+            files.append(("voice", message.voice))
         if message.audio:
-            res.append(("audio", message.audio.file_id))
+            files.append(("audio", message.audio))
         if message.document:
-            res.append(("document", message.document.file_id))
+            files.append(("document", message.document))
+        for t, f in files:
+            res.append((t, f.file_id))
+            _FILE_UNIQUE_IDS[f.file_id] = f.file_unique_id
+            if len(_FILE_UNIQUE_IDS) > _FILE_UNIQUE_IDS_MAX:
+                _FILE_UNIQUE_IDS.popitem(last=False)
     except Exception:
         logger.exception("Failed to gather attachments from message")
     return res
@@ -504,22 +2011,43 @@ async def handle_messages(message: Message):
             now = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
             if field == 'text':
                 if len(value) < 10 or len(value) > 2000:
+                    _release_claim(rid, uid)
                     await message.reply("Неверная длина текста. Отправьте текст 10–2000 символов.")
                     return
-                cursor.execute("UPDATE reviews SET text = ?, admin_id = ?, moderation_date = ? WHERE id = ?", (value, uid, now, rid))
+                sig = await asyncio.to_thread(_minhash, value)
+                cursor.execute(
+                    f"UPDATE reviews SET text = ?, admin_id = ?, moderation_date = ?, version = version + 1, claimed_by = NULL, claimed_at = NULL WHERE id = ? AND {_CLAIM_FREE_SQL}",
+                    (value, uid, now, rid, uid, _claim_cutoff())
+                )
+                if cursor.rowcount == 1:
+                    _reindex_review_text(rid, sig)
                 conn.commit()
-                await message.reply(f"Текст отзыва #{rid} обновлён.")
+                if cursor.rowcount != 1:
+                    await message.reply(_moderation_conflict_text(rid, uid))
+                    return
+                sent = await message.reply(f"Текст отзыва #{rid} обновлён.", reply_markup=admin_keyboard(rid, _review_version(rid)))
+                _sync_admin_messages(rid, f"✏️ Отзыв #{rid} изменён администратором {_admin_display(uid)}.", _reopen_review_kb(rid), skip=sent)
+                _record_admin_message(rid, sent)
             elif field == 'rating':
                 try:
                     rt = int(value)
                     if rt < 1 or rt > 5:
                         raise ValueError
                 except Exception:
+                    _release_claim(rid, uid)
                     await message.reply("Неверный рейтинг. Отправьте число от 1 до 5.")
                     return
-                cursor.execute("UPDATE reviews SET rating = ?, admin_id = ?, moderation_date = ? WHERE id = ?", (rt, uid, now, rid))
+                cursor.execute(
+                    f"UPDATE reviews SET rating = ?, admin_id = ?, moderation_date = ?, version = version + 1, claimed_by = NULL, claimed_at = NULL WHERE id = ? AND {_CLAIM_FREE_SQL}",
+                    (rt, uid, now, rid, uid, _claim_cutoff())
+                )
                 conn.commit()
-                await message.reply(f"Рейтинг отзыва #{rid} обновлён на {rt}⭐.")
+                if cursor.rowcount != 1:
+                    await message.reply(_moderation_conflict_text(rid, uid))
+                    return
+                sent = await message.reply(f"Рейтинг отзыва #{rid} обновлён на {rt}⭐.", reply_markup=admin_keyboard(rid, _review_version(rid)))
+                _sync_admin_messages(rid, f"✏️ Отзыв #{rid} изменён администратором {_admin_display(uid)}.", _reopen_review_kb(rid), skip=sent)
+                _record_admin_message(rid, sent)
         except Exception:
             logger.exception("Error while processing admin edit input")
         return
@@ -802,21 +2330,16 @@ async def cb_admin_approve(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         await query.answer("Только для администраторов.", show_alert=True)
         return
+    _remember_admin(query.from_user)
     try:
-        rid = int(query.data.split("_")[1])
+        rid, version = _parse_moderation_data(query.data)
     except Exception:
         await query.answer("Некорректный ID", show_alert=True)
         return
-    now = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
-    cursor.execute("UPDATE reviews SET status = 'approved', admin_id = ?, moderation_date = ? WHERE id = ?", (query.from_user.id, now, rid))
-    conn.commit()
-    cursor.execute("SELECT user_id FROM reviews WHERE id = ?", (rid,))
-    row = cursor.fetchone()
-    if row and row[0]:
-        try:
-            await bot.send_message(row[0], "Ваш отзыв опубликован. Спасибо!")
-        except Exception:
-            logger.exception("Failed to notify author for review %s", rid)
+    if not _set_review_status(rid, version, query.from_user.id, "approved", "Ваш отзыв опубликован. Спасибо!"):
+        await _answer_moderation_conflict(query, rid)
+        return
+    _sync_admin_messages(rid, f"Отзыв #{rid} — принят ✅ ({_admin_display(query.from_user.id)})", skip=query.message)
     try:
         await query.message.edit_text(f"Отзыв #{rid} — принят ✅")
     except Exception:
@@ -828,22 +2351,17 @@ async def cb_admin_reject(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         await query.answer("Только для администраторов.", show_alert=True)
         return
+    _remember_admin(query.from_user)
     try:
-        rid = int(query.data.split("_")[1])
+        rid, version = _parse_moderation_data(query.data)
     except Exception:
         await query.answer("Некорректный ID", show_alert=True)
         return
 
-    now = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
-    cursor.execute("UPDATE reviews SET status = 'rejected', admin_id = ?, moderation_date = ? WHERE id = ?", (query.from_user.id, now, rid))
-    conn.commit()
-    cursor.execute("SELECT user_id FROM reviews WHERE id = ?", (rid,))
-    row = cursor.fetchone()
-    if row and row[0]:
-        try:
-            await bot.send_message(row[0], "Ваш отзыв отклонён.")
-        except Exception:
-            logger.exception("Failed to notify author for rejection %s", rid)
+    if not _set_review_status(rid, version, query.from_user.id, "rejected", "Ваш отзыв отклонён."):
+        await _answer_moderation_conflict(query, rid)
+        return
+    _sync_admin_messages(rid, f"Отзыв #{rid} — отклонён ❌ ({_admin_display(query.from_user.id)})", skip=query.message)
     try:
         await query.message.edit_text(f"Отзыв #{rid} — отклонён ❌")
     except Exception:
@@ -855,8 +2373,9 @@ async def cb_admin_delete(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         await query.answer("Только для администраторов.", show_alert=True)
         return
+    _remember_admin(query.from_user)
     try:
-        rid = int(query.data.split("_")[1])
+        rid, version = _parse_moderation_data(query.data)
     except Exception:
         await query.answer("Некорректный ID", show_alert=True)
         return
@@ -866,12 +2385,28 @@ async def cb_admin_delete(query: CallbackQuery):
     user_to_notify = row[0] if row and row[0] else None
 
     try:
-        cursor.execute("DELETE FROM reviews WHERE id = ?", (rid,))
+        params = [rid, query.from_user.id, _claim_cutoff()]
+        guard = ""
+        if version is not None:
+            guard = " AND version = ?"
+            params.append(version)
+        cursor.execute(f"DELETE FROM reviews WHERE id = ? AND {_CLAIM_FREE_SQL}{guard}", params)
+        deleted = cursor.rowcount == 1
+        if deleted:
+            _unindex_review(rid)
+        if deleted and user_to_notify:
+            _outbox_put(f"author:{rid}:deleted", "text", user_to_notify, {"text": "Ваш отзыв был полностью удалён модератором."})
         conn.commit()
     except Exception:
+        conn.rollback()
         logger.exception("Failed to DELETE review %s", rid)
         await query.answer("Ошибка при удалении.", show_alert=True)
         return
+    if not deleted:
+        await _answer_moderation_conflict(query, rid)
+        return
+    _kick_outbox()
+    _sync_admin_messages(rid, f"Отзыв #{rid} — удалён 🗑 ({_admin_display(query.from_user.id)})", skip=query.message)
 
     try:
         await query.message.delete()
@@ -883,30 +2418,29 @@ async def cb_admin_delete(query: CallbackQuery):
     except Exception:
         pass
 
-    if user_to_notify:
-        try:
-            await bot.send_message(user_to_notify, "Ваш отзыв был полностью удалён модератором.")
-        except Exception:
-            logger.exception("Failed to notify author for deletion %s", rid)
-
     try:
         await query.answer("Отзыв полностью удалён из БД.")
     except Exception:
         pass
 
-@dp.callback_query(F.data.startswith("edit_") & ~F.data.startswith("edit_field_"))
+@dp.callback_query(F.data.startswith("edit_") & ~F.data.startswith("edit_field_") & ~F.data.startswith("edit_cancel_"))
 async def cb_admin_edit(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         await query.answer("Только для администраторов.", show_alert=True)
         return
+    _remember_admin(query.from_user)
     rid = int(query.data.split("_")[1])
+    # opening the menu is not editing yet: the claim is taken once a field is chosen
+    version = _review_version(rid)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Редактировать текст", callback_data=f"edit_field_{rid}_text")],
         [InlineKeyboardButton(text="Редактировать рейтинг", callback_data=f"edit_field_{rid}_rating")],
-        [InlineKeyboardButton(text="✅ Опубликовать", callback_data=f"approve_{rid}")],
-        [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_{rid}")]
+        [InlineKeyboardButton(text="✅ Опубликовать", callback_data=f"approve_{rid}_{version}")],
+        [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_{rid}_{version}")],
+        [InlineKeyboardButton(text="✖️ Отмена", callback_data=f"edit_cancel_{rid}")]
     ])
-    await query.message.answer("Выберите что редактировать:", reply_markup=kb)
+    sent = await query.message.answer("Выберите что редактировать:", reply_markup=kb)
+    _record_admin_message(rid, sent)
     await query.answer()
 
 @dp.callback_query(F.data.startswith("edit_field_"))
@@ -914,9 +2448,13 @@ async def cb_admin_edit_field(query: CallbackQuery):
     if query.from_user.id not in ADMIN_IDS:
         await query.answer("Только для администраторов.", show_alert=True)
         return
+    _remember_admin(query.from_user)
     parts = query.data.split("_")
     rid = int(parts[2])
     field = parts[3]
+    if not _claim_review(rid, query.from_user.id):
+        await _answer_moderation_conflict(query, rid)
+        return
     PENDING_EDITS[query.from_user.id] = (rid, field)
     if field == 'text':
         await query.message.answer("Отправьте новый текст отзыва (10–2000 символов).")
@@ -924,12 +2462,233 @@ async def cb_admin_edit_field(query: CallbackQuery):
         await query.message.answer("Отправьте новый рейтинг (число 1–5).")
     await query.answer()
 
+@dp.callback_query(F.data.startswith("edit_cancel_"))
+async def cb_admin_edit_cancel(query: CallbackQuery):
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer("Только для администраторов.", show_alert=True)
+        return
+    rid = int(query.data.split("_")[2])
+    pending = PENDING_EDITS.get(query.from_user.id)
+    if pending and pending[0] == rid:
+        PENDING_EDITS.pop(query.from_user.id, None)
+    _release_claim(rid, query.from_user.id)
+    try:
+        await query.message.delete()
+    except Exception:
+        pass
+    await query.answer("Редактирование отменено.")
+
+# ---- retention ----
+def _archive_batch(status: str, cutoff: str, limit: int) -> int:
+    """
+    Moves up to `limit` reviews with given status, moderated (or, for old
+    rows without a moderation date, created) before `cutoff`, into
+    reviews_archive. The age counts from the decision, so a review that
+    waited long for moderation is not archived right after it. One short transaction per batch. Archived reviews
+    leave the duplicate index, so a new review is never flagged as a copy of
+    one admins can no longer open.
+    """
+    rows = conn.execute(
+        "SELECT id FROM reviews WHERE status = ? AND COALESCE(moderation_date, created_at) < ? "
+        "ORDER BY COALESCE(moderation_date, created_at) LIMIT ?",
+        (status, cutoff, limit)
+    ).fetchall()
+    if not rows:
+        return 0
+    ids = [r[0] for r in rows]
+    placeholders = ",".join("?" * len(ids))
+    now = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
+    try:
+        conn.execute(
+            f"INSERT OR REPLACE INTO reviews_archive ({_ARCHIVE_COLUMNS}, archived_at) "
+            f"SELECT {_ARCHIVE_COLUMNS}, ? FROM reviews WHERE id IN ({placeholders})",
+            (now, *ids)
+        )
+        conn.execute(f"DELETE FROM reviews WHERE id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM admin_messages WHERE review_id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM review_signatures WHERE review_id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM review_lsh WHERE review_id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM review_files WHERE review_id IN ({placeholders})", ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(ids)
+
+async def run_retention_once() -> Dict[str, int]:
+    rules = []
+    if RETENTION_REJECTED_DAYS > 0:
+        rules.append(("rejected", RETENTION_REJECTED_DAYS))
+    if RETENTION_APPROVED_DAYS > 0:
+        rules.append(("approved", RETENTION_APPROVED_DAYS))
+
+    moved: Dict[str, int] = {}
+    for status, days in rules:
+        cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat(sep=' ', timespec='seconds')
+        total = 0
+        while True:
+            async with ADMISSION.slot():
+                n = _archive_batch(status, cutoff, RETENTION_BATCH_SIZE)
+            total += n
+            # let handlers (and add_review_to_db) run between batches
+            await asyncio.sleep(RETENTION_BATCH_PAUSE)
+            if n < RETENTION_BATCH_SIZE:
+                break
+        moved[status] = total
+
+    if OUTBOX_RETENTION_DAYS > 0:
+        cutoff = (datetime.utcnow() - timedelta(days=OUTBOX_RETENTION_DAYS)).isoformat(sep=' ', timespec='seconds')
+        total = 0
+        while True:
+            async with ADMISSION.slot():
+                n = conn.execute(
+                    "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox WHERE status IN ('sent', 'failed') AND created_at < ? LIMIT ?)",
+                    (cutoff, RETENTION_BATCH_SIZE)
+                ).rowcount
+                conn.commit()
+            total += n
+            await asyncio.sleep(RETENTION_BATCH_PAUSE)
+            if n < RETENTION_BATCH_SIZE:
+                break
+        moved["outbox"] = total
+
+    while True:
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free_pages <= 0:
+            break
+        conn.execute(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})").fetchall()
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+        if free_pages <= RETENTION_VACUUM_PAGES:
+            break
+    return moved
+
+async def retention_worker():
+    if RETENTION_INTERVAL_SECONDS <= 0:
+        return
+    while True:
+        try:
+            moved = await run_retention_once()
+            if any(moved.values()):
+                logger.info("Retention: archived/purged %s", moved)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Retention job failed")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+# ---- backups ----
+def _rotate_backups(keep: int):
+    names = os.listdir(BACKUP_DIR)
+    # leftovers of a backup interrupted by a crash
+    for name in names:
+        if name.startswith("reviews-") and name.endswith(".db.tmp"):
+            try:
+                os.remove(os.path.join(BACKUP_DIR, name))
+            except OSError:
+                logger.warning("Could not remove stale backup %s", name)
+    snapshots = sorted(name for name in names if name.startswith("reviews-") and name.endswith(".db"))
+    for name in snapshots[:-keep] if keep > 0 else []:
+        for path in (os.path.join(BACKUP_DIR, name), os.path.join(BACKUP_DIR, name + ".sha256")):
+            try:
+                os.remove(path)
+            except OSError:
+                logger.warning("Could not remove old backup %s", path)
+
+def _make_backup() -> Tuple[str, str, int]:
+    """
+    Copies DB_PATH into BACKUP_DIR with the online backup API in a single
+    step. The database is in WAL mode, so the copy reads one consistent
+    snapshot while the bot keeps writing; a step-by-step copy would restart
+    from scratch after every write made through another connection.
+    Returns (path, sha256, size).
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = f"reviews-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.db"
+    path = os.path.join(BACKUP_DIR, name)
+    tmp_path = path + ".tmp"
+
+    src = sqlite3.connect(DB_PATH)
+    dst = sqlite3.connect(tmp_path)
+    completed = False
+    try:
+        src.backup(dst, pages=-1)
+        result = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise RuntimeError(f"quick_check failed: {result}")
+        # keep the snapshot a single self-contained file
+        dst.execute("PRAGMA journal_mode=DELETE")
+        completed = True
+    finally:
+        dst.close()
+        src.close()
+        if not completed:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+
+    os.replace(tmp_path, path)
+    digest = _file_sha256(path)
+    with open(path + ".sha256", "w", encoding="utf-8") as f:
+        f.write(f"{digest}  {name}\n")
+    _rotate_backups(BACKUP_KEEP)
+    return path, digest, os.path.getsize(path)
+
+async def run_backup() -> Dict[str, object]:
+    async with BACKUP_LOCK:
+        BACKUP_STATE["running"] = True
+        started = time.monotonic()
+        try:
+            path, digest, size = await asyncio.to_thread(_make_backup)
+            BACKUP_STATE.update(last_path=path, last_sha256=digest, last_size=size, last_error=None)
+            logger.info("Backup written to %s (%s bytes)", path, size)
+        except Exception as e:
+            BACKUP_STATE["last_error"] = str(e)
+            logger.exception("Backup failed")
+        finally:
+            BACKUP_STATE["running"] = False
+            BACKUP_STATE["last_duration"] = round(time.monotonic() - started, 2)
+            BACKUP_STATE["last_finished"] = datetime.utcnow().isoformat(sep=' ', timespec='seconds')
+    return BACKUP_STATE
+
+async def backup_worker():
+    if BACKUP_INTERVAL_SECONDS <= 0:
+        return
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL_SECONDS)
+        await run_backup()
+
+def _backup_status_text() -> str:
+    st = BACKUP_STATE
+    if st["running"]:
+        return "Резервное копирование выполняется..."
+    if st["last_finished"] is None:
+        return "Резервных копий в этом запуске ещё не было."
+    if st["last_error"]:
+        return f"Последняя попытка ({st['last_finished']}) завершилась ошибкой: {st['last_error']}"
+    return (
+        f"Последняя копия: {os.path.basename(str(st['last_path']))}\n"
+        f"Создана: {st['last_finished']} за {st['last_duration']} с\n"
+        f"Размер: {st['last_size']} байт\n"
+        f"SHA-256: {st['last_sha256']}"
+    )
+
 async def main():
     logger.info("Starting bot...")
+    _start_trace_writer()
+    background_tasks = [
+        asyncio.create_task(retention_worker()),
+        asyncio.create_task(backup_worker()),
+        asyncio.create_task(admin_sync_worker()),
+        asyncio.create_task(outbox_worker()),
+        asyncio.create_task(similarity_backfill_worker()),
+    ]
     try:
         await dp.start_polling(bot)
     finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
         await bot.session.close()
+        _stop_trace_writer()
 
 if __name__ == "__main__":
     try: